@@ -1,49 +1,98 @@
 #!/usr/bin/env python3
-# pylint: disable=too-few-public-methods,invalid-name
+# pylint: disable=too-few-public-methods,too-many-instance-attributes,invalid-name
 # needed: python3 python3-yaml 
 
 """
 A Wi-Fi device presence detector for Home Assistant that runs on OpenWRT
 """
 
-import argparse
+import http.client
 import json
+import random
 import subprocess
-import syslog
+import threading
 import time
-from typing import Dict, Any, List, Callable, Optional
-from urllib import request
-from urllib.error import URLError, HTTPError
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlsplit
+
+try:
+    # orjson parses bytes and encodes straight to bytes, faster than the stdlib json
+    from orjson import loads as json_loads, dumps as json_dumps  # type: ignore
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(obj: Any) -> bytes:  # type: ignore[misc]
+        """Stdlib fallback with the same bytes output as orjson.dumps"""
+        return json.dumps(obj).encode("utf-8")
+
+try:
+    # python3-ubus talks to ubusd over its unix socket, avoiding a ubus process per poll
+    import ubus  # type: ignore
+except ImportError:
+    ubus = None
+
+# Retry policy for HA calls: attempts after the first one, base delay (s) and retryable statuses
+POST_RETRIES = 2
+POST_BACKOFF = 0.3
+POST_RETRY_STATUS = (502, 503, 504)
+# Timeouts (s) of the first attempt and of retries, keeping a failing call below poll_interval
+POST_TIMEOUT = 5
+POST_RETRY_TIMEOUT = 2
+# Errors of a reused keep-alive socket that HA already closed; reconnecting fixes them
+STALE_SOCKET_ERRORS = (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError)
+# Upper bound (s) of the backoff between HA calls while HA keeps failing
+HA_BACKOFF_MAX = 300.0
+
+
+class HAResponse(NamedTuple):
+    """Outcome of a call to the HA REST API"""
+
+    content: bytes
+    ok: bool
+    status: int
 
 
 class Logger:
     """Class to handle logging to syslog"""
 
+    _opened = False
+
     def __init__(self, enable_debug: bool, log2stdout: bool=False) -> None:
         self.enable_debug = enable_debug
         self.log2stdout = log2stdout
+        if log2stdout:
+            return
+        # Only loaded when actually logging to syslog
+        import syslog  # pylint: disable=import-outside-toplevel
+        self._syslog = syslog
+        if not Logger._opened:
+            syslog.openlog(
+                ident="presence-detector",
+                facility=syslog.LOG_DAEMON,
+                logoption=syslog.LOG_PID,
+            )
+            Logger._opened = True
 
-    def log(self, text: str, is_debug: bool = False) -> None:
-        """Log a line to syslog. Only log debug messages when debugging is enabled."""
+    def log(self, text: str, *args: Any, is_debug: bool = False) -> None:
+        """Log a line to syslog. Only log debug messages when debugging is enabled.
+        Arguments are %-formatted into text only when the line is actually logged."""
         if is_debug and not self.enable_debug:
             return
+        if args:
+            text = text % args
         if self.log2stdout:
             print(text)
             return
-        level = syslog.LOG_DEBUG if is_debug else syslog.LOG_INFO
-        syslog.openlog(
-            ident="presence-detector",
-            facility=syslog.LOG_DAEMON,
-            logoption=syslog.LOG_PID,
-        )
-        syslog.syslog(level, text)
+        level = self._syslog.LOG_DEBUG if is_debug else self._syslog.LOG_INFO
+        self._syslog.syslog(level, text)
 
 
 class Settings:
     """Loads all settings from a JSON file and provides built-in defaults"""
 
     def __init__(self, config_file: str) -> None:
-        self._settings = {
+        self._settings: Dict[str, Any] = {
             "hass_url": "http://ha:8123",
             "do_not_track": [],
             "must_track": [],
@@ -54,14 +103,25 @@ class Settings:
             "offline_after": 3,
             "poll_interval": 15,
             "full_sync_polls": 10,
+            "sync_workers": 4,
             "location": "home",
             "away": "not_home",
             "debug": False,
         }
         with open(config_file, "r", encoding="utf-8") as settings:
             self._settings.update(json.load(settings))
+        # MAC lists become lower-cased frozensets for O(1), case-insensitive lookups
+        for key in ("do_not_track", "must_track", "only_track"):
+            self._settings[key] = frozenset(mac.lower() for mac in self._settings[key])
+        self._settings["params"] = {
+            mac.lower(): params for mac, params in self._settings["params"].items()
+        }
+        # Store settings as plain attributes so lookups don't go through __getattr__
+        for key, value in self._settings.items():
+            object.__setattr__(self, key, value)
 
     def __getattr__(self, item: str) -> Any:
+        # Only reached for settings that are neither defaulted nor configured
         return self._settings.get(item)
 
 
@@ -74,160 +134,306 @@ class PresenceDetector:
         self._clients_seen: Dict[str, int] = {}
         debug = debug | self._settings.debug
         self._logger = Logger(debug, log2stdout)
-        for mac in self._settings.must_track:
-            self._clients_seen[mac] = 0
-
-    @staticmethod
-    def _post(url: str, data: dict, headers: dict):
-        req = request.Request(
-            url, data=json.dumps(data).encode("utf-8"), headers=headers
-        )
-        with request.urlopen(req, timeout=5) as response:
-            return type(
-                "", (), {"content": response.read(), "ok": response.code < 400}
-            )()
+        # Settings read for every client on every poll
+        self._offline_after = self._settings.offline_after
+        self._location = self._settings.location
+        self._away = self._settings.away
+        self._source = self._settings.source
+        self._params = self._settings.params
+        self._poll_interval = self._settings.poll_interval
+        self._device_must_5g = self._settings.device_must_5g
+        self._device_min_dawn_score = self._settings.device_min_dawn_score
+        self._do_not_track = self._settings.do_not_track
+        self._only_track = self._settings.only_track
+        self._clients_seen.update(dict.fromkeys(self._settings.must_track, 0))
+        # One keep-alive connection to HA per thread, reused for all 'see' calls
+        see_url = urlsplit(f"{self._settings.hass_url}/api/services/device_tracker/see")
+        self._see_scheme = see_url.scheme
+        self._see_netloc = see_url.netloc
+        self._see_path = see_url.path
+        self._headers = {
+            "Authorization": f"Bearer {self._settings.hass_token}",
+            "Content-Type": "application/json",
+            "Connection": "keep-alive",
+        }
+        self._local = threading.local()
+        # Full syncs fan out over this pool instead of posting one client at a time
+        self._pool = ThreadPoolExecutor(max_workers=max(1, self._settings.sync_workers))
+        # Last payload posted per client, to skip re-posting unchanged state. Entries
+        # expire within one full sync period, so a client skipped by one scheduled full
+        # sync is always re-sent by the next. Any failed call clears the whole cache.
+        self._last_posted: Dict[str, Tuple[bytes, float]] = {}
+        self._post_ttl = (self._settings.full_sync_polls - 0.5) * self._poll_interval
+        self._ubus_connected = False
+        # Exponential backoff while HA is failing, so an outage isn't hammered every poll
+        self._backoff = 0.0
+        self._next_attempt_ts = 0.0
+        self._backoff_lock = threading.Lock()
+        # Encoded (home, away) 'see' bodies per client; only the location differs
+        self._body_templates: Dict[str, Tuple[bytes, bytes]] = {}
+
+    def _ubus_call(self) -> Optional[Dict[str, Any]]:
+        """Query DAWN over a persistent ubus socket, or return None if unavailable"""
+        if ubus is None:
+            return None
+        try:
+            if not self._ubus_connected:
+                ubus.connect()
+                self._ubus_connected = True
+            return ubus.call("dawn", "get_hearing_map", {})[0]
+        except (RuntimeError, OSError, IndexError) as ex:
+            self._logger.log(f"ubus socket call failed, falling back to ubus CLI: {ex}")
+            if self._ubus_connected:
+                ubus.disconnect()
+                self._ubus_connected = False
+            return None
+
+    def _connection(self) -> http.client.HTTPConnection:
+        """Return the calling thread's HA connection, creating it on first use"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if self._see_scheme == "https":
+                conn = http.client.HTTPSConnection(self._see_netloc, timeout=POST_TIMEOUT)
+            else:
+                conn = http.client.HTTPConnection(self._see_netloc, timeout=POST_TIMEOUT)
+            self._local.conn = conn
+        return conn
+
+    def _post(self, body: bytes) -> HAResponse:
+        """POST to the HA 'see' service, retrying dropped connections and gateway errors"""
+        conn = self._connection()
+        attempt = 0
+        while True:
+            reused = conn.sock is not None
+            conn.timeout = POST_TIMEOUT if attempt == 0 else POST_RETRY_TIMEOUT
+            if reused:
+                conn.sock.settimeout(conn.timeout)
+            try:
+                conn.request("POST", self._see_path, body=body, headers=self._headers)
+                response = conn.getresponse()
+                # The body must be drained before the connection can be reused
+                content = response.read()
+            except (http.client.HTTPException, OSError) as ex:
+                # The next request on a closed connection reconnects
+                conn.close()
+                if reused and isinstance(ex, STALE_SOCKET_ERRORS):
+                    # HA closed the idle keep-alive socket: retry right away, not an attempt
+                    continue
+                if attempt >= POST_RETRIES:
+                    raise
+            else:
+                if response.status not in POST_RETRY_STATUS or attempt >= POST_RETRIES:
+                    return HAResponse(content, response.status < 400, response.status)
+            time.sleep(POST_BACKOFF * 2 ** attempt)
+            attempt += 1
+
+    def _encode_body(self, client: str, location: str) -> bytes:
+        """Build the JSON body of a 'see' call for a client at the given location"""
+        body = {"mac": client, "location_name": location,
+                "source_type": self._source}
+        if client in self._params:
+            body.update(self._params[client])
+        return json_dumps(body)
 
     def _ha_seen(self, client: str, seen: bool = True) -> bool:
         """Call the HA device tracker 'see' service to update home/away status"""
-        if seen:
-            location = self._settings.location
-        else:
-            location = self._settings.away
-
-        body = {"mac": client, "location_name": location, 
-                "source_type": self._settings.source}
-        if client in self._settings.params:
-            body.update(self._settings.params[client])
+        templates = self._body_templates.get(client)
+        if templates is None:
+            templates = (self._encode_body(client, self._location),
+                         self._encode_body(client, self._away))
+            self._body_templates[client] = templates
+        payload = templates[0] if seen else templates[1]
+
+        now = time.monotonic()
+        last = self._last_posted.get(client)
+        if last and last[0] == payload and now - last[1] < self._post_ttl:
+            self._logger.log("%s unchanged, skipping", client, is_debug=True)
+            return True
+        if now < self._next_attempt_ts:
+            self._logger.log("HA backoff, not sending %s", client, is_debug=True)
+            return False
 
         try:
-            response = self._post(
-                f"{self._settings.hass_url}/api/services/device_tracker/see",
-                data=body,
-                headers={"Authorization": f"Bearer {self._settings.hass_token}"},
-            )
-            self._logger.log(f"API Response: {response.content!r}", is_debug=True)
-        #except (URLError, HTTPError) as ex:
+            response = self._post(payload)
+            self._logger.log("API Response: %r", response.content, is_debug=True)
         except Exception as ex:
             self._logger.log(str(ex))
-            # Force full sync when HA returns
-            self._full_sync_counter = 0
+            self._ha_failed(now)
             return False
         if not response.ok:
-            self._full_sync_counter = 0
-        return response.ok
+            self._logger.log("HA returned HTTP %d for %s", response.status, client)
+            # A 4xx is specific to this request (e.g. bad params), so don't hold back others
+            self._ha_failed(now, backoff=response.status >= 500)
+            return False
+        self._backoff = 0.0
+        self._last_posted[client] = (payload, now)
+        return True
+
+    def _ha_failed(self, started: float, backoff: bool = True) -> None:
+        """Schedule a full sync and optionally back off further calls after a failed HA call"""
+        # Force full sync when HA returns
+        self._full_sync_counter = 0
+        # HA's state is unknown after a failure, so the forced sync must re-send everyone
+        self._last_posted.clear()
+        if not backoff:
+            return
+        with self._backoff_lock:
+            # Parallel calls of the same batch all fail together: only the first one that
+            # started outside the current window grows the backoff
+            if started < self._next_attempt_ts:
+                return
+            # Jitter keeps several routers from retrying in lockstep
+            self._backoff = min(self._backoff * 2 + random.uniform(0, 0.5), HA_BACKOFF_MAX)
+            self._next_attempt_ts = time.monotonic() + self._backoff
+
+    def _ha_seen_many(self, clients: List[str], seen: bool = True) -> Dict[str, bool]:
+        """Send the 'see' calls for several clients as one batch over the connection pool"""
+        if len(clients) <= 1:
+            return {client: self._ha_seen(client, seen) for client in clients}
+        pending = {client: self._pool.submit(self._ha_seen, client, seen) for client in clients}
+        return {client: future.result() for client, future in pending.items()}
 
     def full_sync(self) -> None:
         """Syncs the state of all devices once every X polls"""
         self._full_sync_counter -= 1
         if self._full_sync_counter <= 0:
-            sync_ok = True
-            for client, offline_after in self._clients_seen.copy().items():
-                if offline_after == self._settings.offline_after:
-                    self._logger.log(f"full sync {client}", is_debug=True)
-                    sync_ok &= self._ha_seen(client)
+            batch = []
+            # No snapshot needed: _ha_seen never touches _clients_seen
+            for client, offline_after in self._clients_seen.items():
+                if offline_after == self._offline_after:
+                    self._logger.log("full sync %s", client, is_debug=True)
+                    batch.append(client)
             # Reset timer only when all syncs were successful
-            if sync_ok:
+            if all(self._ha_seen_many(batch).values()):
                 self._full_sync_counter = self._settings.full_sync_polls
 
-    def set_client_away(self, client: str) -> None:
-        """Mark a client as away in HA"""
-        self._logger.log(f"Device {client} is now away")
-        if self._ha_seen(client, False):
-            # Away call to HA was successful -> remove from list
-            if client in self._clients_seen:
-                del self._clients_seen[client]
-        else:
-            # Call failed -> retry next time
-            self._clients_seen[client] = 1
-
-    def set_client_home(self, client: str, ap_addr: str):
-        """Mark a client as home in HA"""
-        if client in self._settings.do_not_track:
-            return
-        if self._settings.only_track and client not in self._settings.only_track:
-            return
-        # Add ap prefix if ap_addr defined in settings
-        #ap_loc = ""
-        #if ap_addr in self._settings.ap2room:
-        #    ap_loc = self._settings.ap2room[ap_addr]
-        if client not in self._clients_seen:
-            self._logger.log(f"Device {client} is now at {self._settings.location}")
-            if self._ha_seen(client):
-                self._clients_seen[client] = self._settings.offline_after
-        else:
-            self._clients_seen[client] = self._settings.offline_after
+    def set_clients_away(self, clients: List[str]) -> None:
+        """Mark clients as away in HA"""
+        for client in clients:
+            self._logger.log(f"Device {client} is now away")
+        for client, ok in self._ha_seen_many(clients, False).items():
+            if ok:
+                # Away call to HA was successful -> remove from list and drop its caches
+                if client in self._clients_seen:
+                    del self._clients_seen[client]
+                self._body_templates.pop(client, None)
+                self._last_posted.pop(client, None)
+            else:
+                # Call failed -> retry next time
+                self._clients_seen[client] = 1
+
+    def set_clients_home(self, clients: Dict[str, str]) -> None:
+        """Mark clients as home in HA, given a mapping of client to the AP it is heard best on"""
+        arrived = []
+        for client in clients:
+            # do_not_track clients are already filtered out by run()
+            if self._only_track and client not in self._only_track:
+                continue
+            # Add ap prefix if ap_addr defined in settings
+            #ap_loc = ""
+            #if clients[client] in self._settings.ap2room:
+            #    ap_loc = self._settings.ap2room[clients[client]]
+            if client not in self._clients_seen:
+                self._logger.log(f"Device {client} is now at {self._location}")
+                arrived.append(client)
+            elif self._clients_seen[client] != self._offline_after:
+                self._clients_seen[client] = self._offline_after
+        for client, ok in self._ha_seen_many(arrived).items():
+            if ok:
+                self._clients_seen[client] = self._offline_after
+            else:
+                # Not tracked yet, so nothing would evict this if the client never returns
+                self._body_templates.pop(client, None)
 
     def _get_all_online_clients(self) -> Dict[str, Any]:
         """Call ubus and get all online clients"""
-        clients = {}
-        process = subprocess.run(
-            ["ubus", "call", "dawn", "get_hearing_map"],
-            capture_output=True,
-            text=True,
-            check=False,
-        )
-        if process.returncode != 0:
-            self._logger.log(
-                f"Error running ubus for `ubus call dawn get_hearing_map`: {process.stderr}"
+        response = self._ubus_call()
+        if response is None:
+            process = subprocess.run(
+                ["ubus", "call", "dawn", "get_hearing_map"],
+                capture_output=True,
+                check=False,
             )
-        response = json.loads(process.stdout)
-        clients.update( response[self._settings.ssid] )
-        return clients
+            if process.returncode != 0:
+                self._logger.log(
+                    "Error running ubus for `ubus call dawn get_hearing_map`: "
+                    f"{process.stderr.decode(errors='replace')}"
+                )
+            response = json_loads(process.stdout)
+        return {mac.lower(): aps for mac, aps in response[self._settings.ssid].items()}
 
     def _on_leave(self, client: str):
         """Callback for the Ubus watcher thread when a client leaves"""
-        if self._settings.offline_after <= 1:
-            self.set_client_away(client)
+        if self._offline_after <= 1:
+            self.set_clients_away([client])
 
 
     @staticmethod
     def _get_ap_highest_score(json_now):
-        ap_highest_score = -99
-        ap_highest = ""
-        for ap in json_now:
-            if json_now[ap]["score"] > ap_highest_score:
-                ap_highest_score = json_now[ap]["score"]
-                ap_highest = ap
-        return ap_highest, ap_highest_score
+        if not json_now:
+            return "", -99
+        # Walk (ap, entry) pairs so the winner's score needs no second lookup
+        ap_highest, entry = max(json_now.items(), key=lambda item: item[1]["score"])
+        return ap_highest, entry["score"]
+
+    @staticmethod
+    def _get_max_channel_utilization(json_now):
+        return max((entry["channel_utilization"] for entry in json_now.values()), default=0)
     
     def run(self) -> None:
         """Main loop for the presence detector"""
 
-        # The main (sync) polling loop
+        # The main (sync) polling loop, scheduled on fixed monotonic deadlines
+        next_poll = time.monotonic()
         while True:
             seen_now = self._get_all_online_clients()
             # Periodically perform a full sync of all clients in case of connection failure
             self.full_sync()
-            # Perform a regular 'changes only' sync with HA
-            for client in seen_now:
-                if(self._settings.device_must_5g):
-                    if(seen_now[client]["channel_utilization"] < 15): continue
-                ap_name, highest_dawn_score = self._get_ap_highest_score(seen_now[client])
+            # Perform a regular 'changes only' sync with HA, batching this poll's updates
+            arrived = {}
+            for client in seen_now.keys() - self._do_not_track:
+                # Already tracked clients need no update, skip them before any scoring
+                if client in self._clients_seen:
+                    continue
+                aps = seen_now[client]
+                if self._device_must_5g and self._get_max_channel_utilization(aps) < 15:
+                    continue
+                ap_name, highest_dawn_score = self._get_ap_highest_score(aps)
                 # First time showup must has high dawn score
-                if(client in self._clients_seen or 
-                    highest_dawn_score < self._settings.device_min_dawn_score):
+                if highest_dawn_score < self._device_min_dawn_score:
                     continue
-                self.set_client_home(client, ap_name)
+                arrived[client] = ap_name
+            self.set_clients_home(arrived)
 
-            # Mark unseen clients as away after 'offline_after' intervals
-            for client in self._clients_seen.copy():
-                if client in seen_now:
-                    continue
+            # Mark unseen clients as away after 'offline_after' intervals. Only the unseen
+            # clients are collected, as set_clients_away may remove them from the dict.
+            gone = []
+            for client in [c for c in self._clients_seen if c not in seen_now]:
                 self._clients_seen[client] -= 1
                 if self._clients_seen[client] > 0:
                     continue
                 # Client has not been seen x times, mark as away
-                self.set_client_away(client)
+                gone.append(client)
+            self.set_clients_away(gone)
 
-            time.sleep(self._settings.poll_interval)
+            # Sleep until the next deadline so the cadence doesn't drift with HA/ubus latency
+            next_poll += self._poll_interval
+            delay = next_poll - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # Overran the interval: poll again right away and restart the schedule
+                self._logger.log("Poll overrun by %.2fs", -delay, is_debug=True)
+                next_poll = time.monotonic()
 
-            self._logger.log(f"Clients seen: {self._clients_seen}", is_debug=True)
+            self._logger.log("Clients seen: %s", self._clients_seen, is_debug=True)
 
   
 
 
 def main():
     """Main entrypoint: parse arguments and start all threads"""
+    import argparse  # pylint: disable=import-outside-toplevel
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-c",